@@ -4,7 +4,8 @@ Very basic HTTP server that just listens on a port and responds.
 
 import base64
 import hashlib
-import select
+import logging
+import selectors
 import socket
 
 import toy_websocket_frame
@@ -12,7 +13,11 @@ import toy_websocket_frame
 TCP_IP = '127.0.0.1'
 TCP_PORT = 5006
 BUFFER_SIZE = 1024 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 1024 * 1024
 WS_ENDPOINT = '/websocket'
+# Set to logging.DEBUG to see everything the server is doing.
+LOG_LEVEL = logging.WARNING
 
 DEFAULT_HTTP_RESPONSE = (
     b'''<HTML><HEAD><meta http-equiv="content-type"
@@ -22,7 +27,51 @@ content="text/html;charset=utf-8">\r\n
 Welcome to the default.\r\n
 </BODY></HTML>\r\n\r\n''')
 
+# The whole 200 response never changes, so we only build it once.
+DEFAULT_HTTP_OK_RESPONSE = (
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Length: %d\r\n'
+    b'Connection: close\r\n'
+    b'\r\n' % len(DEFAULT_HTTP_RESPONSE) +
+    DEFAULT_HTTP_RESPONSE)
+
 MAGIC_WEBSOCKET_UUID_STRING = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAGIC_WEBSOCKET_UUID_BYTES = MAGIC_WEBSOCKET_UUID_STRING.encode('ascii')
+
+# Everything in the handshake response except the accept key is constant.
+WS_HANDSHAKE_RESPONSE_PREFIX = (
+    b'HTTP/1.1 101 Switching Protocols\r\n'
+    b'Upgrade: websocket\r\n'
+    b'Connection: Upgrade\r\n'
+    b'Sec-WebSocket-Accept: ')
+WS_HANDSHAKE_RESPONSE_SUFFIX = b'\r\n\r\n'
+
+# A close frame with status 1009 (message too big).
+# See https://datatracker.ietf.org/doc/html/rfc6455#section-7.4.1
+WS_CLOSE_MESSAGE_TOO_BIG = b'\x88\x02\x03\xf1'
+
+# Header names come from a pretty small set, so we cache the lowercased name
+# for each raw name we've seen. It's capped so odd clients can't grow it
+# forever.
+MAX_HEADER_NAME_CACHE_SIZE = 64
+_header_name_cache = {}
+
+logger = logging.getLogger(__name__)
+
+# We only ever read from one socket at a time, so every read can share one
+# preallocated buffer rather than recv allocating a new bytes each time.
+_receive_buffer = bytearray(BUFFER_SIZE)
+_receive_view = memoryview(_receive_buffer)
+
+
+class Connection:
+    """State for a client socket that has to survive between reads."""
+
+    def __init__(self):
+        # Whether the socket has been upgraded to a websocket.
+        self.is_websocket = False
+        # Bytes we've read from the socket but haven't handled yet.
+        self.buffer = bytearray()
 
 
 def main():
@@ -35,140 +84,232 @@ def main():
     tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcp_socket.bind((TCP_IP, TCP_PORT))
 
-    tcp_socket.listen(1)
-    print('Listening on port: ', TCP_PORT)
+    # Let connections queue up while we're busy, and don't block in accept
+    # once we've drained them (see handle_new_connection).
+    tcp_socket.listen(socket.SOMAXCONN)
+    tcp_socket.setblocking(False)
+    logger.info('Listening on port: %s', TCP_PORT)
 
-    input_sockets = [tcp_socket]
-    output_sockets = []  # Maybe use, we'll see
-    xlist = []  # Not using
-
-    ws_sockets = []
+    # The selector picks the best readiness API for the platform (epoll on
+    # Linux, kqueue on BSD/macOS). Each client socket is registered with its
+    # Connection, so we know how to handle it when it's ready. The main door
+    # socket doesn't have one.
+    selector = selectors.DefaultSelector()
+    selector.register(tcp_socket, selectors.EVENT_READ, data=None)
 
     while True:
-        # Get the sockets that are ready to read (the first of the
-        # three-tuple).
-        readable_sockets = select.select(input_sockets,
-                                         output_sockets,
-                                         xlist,
-                                         5)[0]
-
-        for ready_socket in readable_sockets:
-            # Make sure it's not already closed
-            if (ready_socket.fileno() == -1):
-                continue
-            if ready_socket == tcp_socket:
-                print('Handling main door socket')
-                handle_new_connection(tcp_socket, input_sockets)
-            elif ready_socket in ws_sockets:
-                print('Handling websocket message')
-                handle_websocket_message(ready_socket, input_sockets,
-                                         ws_sockets)
+        for key, _ in selector.select(timeout=5):
+            ready_socket = key.fileobj
+            connection = key.data
+            if connection is None:
+                logger.debug('Handling main door socket')
+                handle_new_connection(tcp_socket, selector)
+            elif connection.is_websocket:
+                logger.debug('Handling websocket message')
+                handle_websocket_message(ready_socket, selector, connection)
             else:
-                print('Handling regular socket read')
-                handle_request(ready_socket, input_sockets, ws_sockets)
+                logger.debug('Handling regular socket read')
+                handle_request(ready_socket, selector, connection)
 
 
-def handle_new_connection(main_door_socket, input_sockets):
+def handle_new_connection(main_door_socket, selector):
     # When we get a connection on the main socket, we want to accept a new
-    # connection and add it to our input socket list. When we loop back around,
-    # that socket will be ready to read from.
-    client_socket, client_addr = main_door_socket.accept()
-    print('New socket', client_socket.fileno(), 'from address:', client_addr)
-    input_sockets.append(client_socket)
-
-
-def handle_websocket_message(client_socket, input_sockets, ws_sockets):
-    # Let's assume that we get a full single frame in each recv (may not
-    # be true IRL)
-    data_in_bytes = client_socket.recv(BUFFER_SIZE)
-
-    websocket_frame = toy_websocket_frame.WebsocketFrame()
-    websocket_frame.populateFromWebsocketFrameMessage(data_in_bytes)
-
-    print('Received message:', websocket_frame.get_payload_data().decode('utf-8'))
-    return
-
-
-def handle_request(client_socket, input_sockets, ws_sockets):
-    print('Handling request from client socket:', client_socket.fileno())
-    message = ''
-    # Very naive approach: read until we find the last blank line
+    # connection and register it with the selector. When we loop back around,
+    # that socket will be ready to read from. There may be several waiting, so
+    # accept all of them now rather than going back through select for each.
     while True:
-        data_in_bytes = client_socket.recv(BUFFER_SIZE)
-        # Connnection on client side has closed.
-        if len(data_in_bytes) == 0:
-            close_socket(client_socket, input_sockets, ws_sockets)
+        try:
+            client_socket, client_addr = main_door_socket.accept()
+        except BlockingIOError:
             return
-        message_segment = data_in_bytes.decode()
-        message += message_segment
-        if (len(message) > 4 and message_segment[-4:] == '\r\n\r\n'):
-            break
-
-    print('Received message:')
-    print(message)
-
-    (method, target, http_version, headers_map) = parse_request(message)
-
-    print('method, target, http_version:', method, target, http_version)
-    print('headers:')
-    print(headers_map)
+        logger.debug('New socket %s from address: %s',
+                     client_socket.fileno(), client_addr)
+        # Client sockets are non-blocking so that one slow client can't stall
+        # the loop. We only read what's there and pick back up on the next
+        # event.
+        client_socket.setblocking(False)
+        # Our responses are small, so don't let Nagle hold them back waiting
+        # for more data, and let the OS notice dead peers on idle websockets.
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        selector.register(client_socket, selectors.EVENT_READ,
+                          data=Connection())
+
+
+def handle_websocket_message(client_socket, selector, connection):
+    # We can't assume we get exactly one frame per recv, so we add whatever
+    # we get to the connection's buffer and handle any frames that are
+    # complete. The rest waits for the next read.
+    bytes_read = read_into_connection_buffer(client_socket, connection)
+    if bytes_read is None:
+        return
+    # Connnection on client side has closed.
+    if bytes_read == 0:
+        close_socket(client_socket, selector)
+        return
+    handle_buffered_websocket_frames(client_socket, selector, connection)
+
+
+def handle_buffered_websocket_frames(client_socket, selector, connection):
+    frame_buffer = connection.buffer
+    while True:
+        # The frame header tells us how long the whole frame is, so we know
+        # whether we have all of it yet.
+        frame_length = toy_websocket_frame.get_frame_length(frame_buffer)
+        if frame_length is None:
+            return
+        # Don't let a client make us buffer an arbitrarily large frame.
+        if frame_length > MAX_FRAME_SIZE:
+            try:
+                client_socket.sendall(WS_CLOSE_MESSAGE_TOO_BIG)
+            except OSError:
+                pass
+            close_socket(client_socket, selector)
+            return
+        if len(frame_buffer) < frame_length:
+            return
+        data_in_bytes = frame_buffer[:frame_length]
+        del frame_buffer[:frame_length]
+
+        websocket_frame = toy_websocket_frame.WebsocketFrame()
+        websocket_frame.populateFromWebsocketFrameMessage(data_in_bytes)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Received message: %s',
+                         websocket_frame.get_payload_data().decode('utf-8'))
+
+
+def read_into_connection_buffer(client_socket, connection):
+    # Reads whatever the socket has into the shared receive buffer and adds it
+    # to the connection's buffer. Returns how many bytes we got (0 means the
+    # client closed the connection), or None if there was nothing to read.
+    try:
+        bytes_read = client_socket.recv_into(_receive_view)
+    except BlockingIOError:
+        return None
+    except ConnectionError:
+        # The client reset the connection, which we treat like it closing.
+        return 0
+    connection.buffer += _receive_view[:bytes_read]
+    return bytes_read
+
+
+def handle_request(client_socket, selector, connection):
+    logger.debug('Handling request from client socket: %s',
+                 client_socket.fileno())
+    request_bytes = connection.buffer
+    # Very naive approach: read until we find the last blank line. We only do
+    # one read per event, so we may have to wait for the next one to see the
+    # rest of the request.
+    bytes_read = read_into_connection_buffer(client_socket, connection)
+    if bytes_read is None:
+        return
+    # Connnection on client side has closed.
+    if bytes_read == 0:
+        close_socket(client_socket, selector)
+        return
+    # The blank line could straddle the previous read, so back up a few bytes
+    # before the new data when looking for it.
+    search_start = max(0, len(request_bytes) - bytes_read - 3)
+    headers_end = request_bytes.find(b'\r\n\r\n', search_start)
+    if headers_end == -1:
+        if len(request_bytes) > MAX_HEADER_SIZE:
+            client_socket.sendall(
+                b'HTTP/1.1 431 Request Header Fields Too Large\r\n\r\n')
+            close_socket(client_socket, selector)
+        return
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Received message:\n%s', request_bytes.decode('latin-1'))
+
+    (method, target, http_version, headers_map) = parse_request(
+        bytes(request_bytes[:headers_end + 4]))
+    # Anything after the headers is already the next thing from the client
+    # (e.g. the first websocket frame), so leave it in the buffer.
+    del request_bytes[:headers_end + 4]
+
+    logger.debug('method, target, http_version: %s %s %s',
+                 method, target, http_version)
+    logger.debug('headers: %s', headers_map)
 
     # We will know it's a websockets request if the handshake request is
     # present.
     if target == WS_ENDPOINT:
-        print('request to ws endpoint!')
+        logger.debug('request to ws endpoint!')
         if is_valid_ws_handshake_request(method,
                                          target,
                                          http_version,
                                          headers_map):
             handle_ws_handshake_request(
                 client_socket,
-                ws_sockets,
+                connection,
                 headers_map)
+            # The client may have sent frames right behind the handshake.
+            handle_buffered_websocket_frames(
+                client_socket, selector, connection)
             return
         else:
             # Invalid WS request.
-            client_socket.send(b'HTTP/1.1 400 Bad Request')
-            close_socket(client_socket, input_sockets, ws_sockets)
+            client_socket.sendall(b'HTTP/1.1 400 Bad Request')
+            close_socket(client_socket, selector)
             return
 
-    # For now, just return a 200. Should probably return length too, eh
-    client_socket.send(b'HTTP/1.1 200 OK\r\n\r\n' + DEFAULT_HTTP_RESPONSE)
-    close_socket(client_socket, input_sockets, ws_sockets)
+    # For now, just return a 200.
+    client_socket.sendall(DEFAULT_HTTP_OK_RESPONSE)
+    close_socket(client_socket, selector)
 
 
 def handle_ws_handshake_request(client_socket,
-                                ws_sockets,
+                                connection,
                                 headers_map):
-    ws_sockets.append(client_socket)
+    # From now on, reads on this socket are websocket frames.
+    connection.is_websocket = True
 
     # To handle a WS handshake, we have to generate an accept key from the
     # sec-websocket-key and a magic string.
     sec_websocket_accept_value = generate_sec_websocket_accept(
         headers_map.get('sec-websocket-key'))
 
-    # We can now build the response, telling the client we're switching
+    # We can now send the response, telling the client we're switching
     # protocols while providing the key.
-    websocket_response = ''
-    websocket_response += 'HTTP/1.1 101 Switching Protocols\r\n'
-    websocket_response += 'Upgrade: websocket\r\n'
-    websocket_response += 'Connection: Upgrade\r\n'
-    websocket_response += (
-        'Sec-WebSocket-Accept: ' + sec_websocket_accept_value.decode() + '\r\n')
-    websocket_response += '\r\n'
+    websocket_response = [
+        WS_HANDSHAKE_RESPONSE_PREFIX,
+        sec_websocket_accept_value,
+        WS_HANDSHAKE_RESPONSE_SUFFIX,
+    ]
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('response:\n%s',
+                     b''.join(websocket_response).decode('latin-1'))
 
-    print('\nresponse:\n',websocket_response)
+    send_parts(client_socket, websocket_response)
 
-    client_socket.send(websocket_response.encode())
+
+def send_parts(client_socket, parts):
+    # sendmsg hands all the parts to the kernel in one (writev style) call, so
+    # we don't have to join them into one bytes first. If it doesn't take
+    # everything, we fall back to sending whatever's left. It's Unix only, so
+    # elsewhere we just join them.
+    if not hasattr(client_socket, 'sendmsg'):
+        client_socket.sendall(b''.join(parts))
+        return
+    bytes_sent = client_socket.sendmsg(parts)
+    if bytes_sent < sum(len(part) for part in parts):
+        client_socket.sendall(b''.join(parts)[bytes_sent:])
 
 
 def generate_sec_websocket_accept(sec_websocket_key):
     # We generate the accept key by concatenating the sec-websocket-key
     # and the magic string, Sha1 hashing it, and base64 encoding it.
     # See https://datatracker.ietf.org/doc/html/rfc6455#page-7
-    combined = sec_websocket_key + MAGIC_WEBSOCKET_UUID_STRING
-    hashed_combined_string = hashlib.sha1(combined.encode())
-    encoded = base64.b64encode(hashed_combined_string.digest())
+    # This isn't a security use of SHA-1, so we can say so, which keeps
+    # OpenSSL's (hardware accelerated) implementation usable in FIPS builds.
+    sha1 = hashlib.sha1(usedforsecurity=False)
+    if isinstance(sec_websocket_key, str):
+        sec_websocket_key = sec_websocket_key.encode('latin-1')
+    sha1.update(sec_websocket_key)
+    sha1.update(MAGIC_WEBSOCKET_UUID_BYTES)
+    encoded = base64.b64encode(sha1.digest())
     return encoded
 
 
@@ -197,26 +338,34 @@ def parse_request(request):
     # Assume headers and body are split by '\r\n\r\n' and we always have them.
     # Also assume all headers end with'\r\n'.
     # Also assume it starts with the method.
-    split_request = request.split('\r\n\r\n')[0].split('\r\n')
-    [method, target, http_version] = split_request[0].split(' ')
+    # We work on the raw bytes and only decode the pieces we hand back.
+    split_request = request.split(b'\r\n\r\n', 1)[0].split(b'\r\n')
+    [method, target, http_version] = split_request[0].split(b' ', 2)
     headers = split_request[1:]
     for header_entry in headers:
-        [header_name, value] = header_entry.split(': ')
+        header_name, _, value = header_entry.partition(b': ')
         # Headers are case insensitive, so we can just keep track in lowercase.
         # Here's a trick though: the case of the values matter. Otherwise,
         # things don't hash and encode right!
-        headers_map[header_name.lower()] = value
-    return (method, target, http_version, headers_map)
-
-
-def close_socket(client_socket, input_sockets, ws_sockets):
-    print('closing socket')
-    if client_socket in ws_sockets:
-        ws_sockets.remove(client_socket)
-    input_sockets.remove(client_socket)
+        lowercase_name = _header_name_cache.get(header_name)
+        if lowercase_name is None:
+            lowercase_name = header_name.decode('latin-1').lower()
+            if len(_header_name_cache) < MAX_HEADER_NAME_CACHE_SIZE:
+                _header_name_cache[header_name] = lowercase_name
+        headers_map[lowercase_name] = value.decode('latin-1')
+    return (method.decode('latin-1'),
+            target.decode('latin-1'),
+            http_version.decode('latin-1'),
+            headers_map)
+
+
+def close_socket(client_socket, selector):
+    logger.debug('closing socket')
+    selector.unregister(client_socket)
     client_socket.close()
     return
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=LOG_LEVEL)
     main()
@@ -1,90 +1,175 @@
+import ctypes
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Optional SIMD unmasking from ws_mask.c (see that file for how to build it).
+try:
+    _ws_mask_lib = ctypes.CDLL(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ws_mask.so'))
+    _ws_mask_lib.ws_unmask.argtypes = [
+        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    _ws_mask_lib.ws_unmask.restype = None
+except (OSError, AttributeError):
+    # Either it hasn't been built, or it's an old build without ws_unmask.
+    _ws_mask_lib = None
+
+# Below these payload lengths, the setup cost of the C and numpy paths is more
+# than the plain Python big-int XOR costs, so we only use them above.
+_SIMD_UNMASK_MIN_LENGTH = 512
+_NUMPY_UNMASK_MIN_LENGTH = 768
+
+
+def _unmask(encoded_payload, masking_key, offset=0):
+    # The mask is applied per 4 bytes, so if we're starting partway through a
+    # payload we have to rotate the key to line up with the payload index.
+    rotation = offset % 4
+    if rotation:
+        masking_key = masking_key[rotation:] + masking_key[:rotation]
+    # Every path hands back a bytearray. The C and numpy paths unmask a copy
+    # of the payload in place, so this saves them a second copy into bytes.
+    payload_length = len(encoded_payload)
+    if (_ws_mask_lib is not None and
+            payload_length >= _SIMD_UNMASK_MIN_LENGTH):
+        payload_data = bytearray(encoded_payload)
+        buffer = (ctypes.c_char * payload_length).from_buffer(payload_data)
+        _ws_mask_lib.ws_unmask(
+            buffer, buffer, payload_length, bytes(masking_key))
+        del buffer
+        return payload_data
+    if np is not None and payload_length >= _NUMPY_UNMASK_MIN_LENGTH:
+        # With numpy, we can look at the payload as 4 byte words and XOR each
+        # one with the whole key in one vectorized call, then do the last few
+        # bytes by hand.
+        payload_data = bytearray(encoded_payload)
+        aligned_length = payload_length - payload_length % 4
+        words = np.frombuffer(
+            payload_data, dtype=np.uint8)[:aligned_length].view(np.uint32)
+        key_word = np.frombuffer(bytes(masking_key), dtype=np.uint32)[0]
+        np.bitwise_xor(words, key_word, out=words)
+        del words
+        for i in range(aligned_length, payload_length):
+            payload_data[i] ^= masking_key[i - aligned_length]
+        return payload_data
+    # To decode the payload, we do a bitwise XOR with the mask at the mask
+    # index determined by the payload index modulo 4. If we tile the key out
+    # to the payload length, we can treat both as one big integer and do the
+    # whole payload in a single XOR rather than a byte at a time.
+    tiled_key = (bytes(masking_key) * ((payload_length + 3) // 4))[
+        :payload_length]
+    decoded = (int.from_bytes(encoded_payload, byteorder='big') ^
+               int.from_bytes(tiled_key, byteorder='big'))
+    return bytearray(decoded.to_bytes(payload_length, byteorder='big'))
+
+
+def _parse_frame_lengths(data_in_bytes):
+    """Returns (header length, payload length) for the frame at the start of
+    data_in_bytes, or None if we haven't got enough of its header yet. The
+    header length includes the masking key, if there is one."""
+    if len(data_in_bytes) < 2:
+        return None
+    second_byte = data_in_bytes[1]
+    # The payload length is the first 7 bits of the 2nd byte, or more if it's
+    # longer. If the payload length is <126, whatever comes next starts at the
+    # 3rd byte.
+    header_length = 2
+    payload_length = second_byte & 0b01111111
+    # Longer payloads keep their length in the next 2 or 8 bytes, in network
+    # (big endian) byte order.
+    if payload_length == 126:
+        header_length = 4
+        if len(data_in_bytes) < header_length:
+            return None
+        payload_length = struct.unpack_from('!H', data_in_bytes, 2)[0]
+    elif payload_length == 127:
+        header_length = 10
+        if len(data_in_bytes) < header_length:
+            return None
+        payload_length = struct.unpack_from('!Q', data_in_bytes, 2)[0]
+    # The masking key comes right after the length.
+    if second_byte & 0b10000000:
+        header_length += 4
+    return header_length, payload_length
+
+
+def get_frame_length(data_in_bytes):
+    """Returns the total length of the frame at the start of data_in_bytes,
+    or None if we haven't got enough of its header to know yet."""
+    lengths = _parse_frame_lengths(data_in_bytes)
+    if lengths is None:
+        return None
+    header_length, payload_length = lengths
+    return header_length + payload_length
+
+
 # See https://datatracker.ietf.org/doc/html/rfc6455#section-5.2
 class WebsocketFrame:
     """A simple representation of a websocket frame"""
-    _fin = 0
-    _rsv1 = 0
-    _rsv2 = 0
-    _rsv3 = 0
-    _opcode = 0
-    _payload_length = 0
-    _payload_data = b''
+    # Frames are small and we may make lots of them, so skip the per-instance
+    # __dict__.
+    __slots__ = ('_fin', '_rsv1', '_rsv2', '_rsv3', '_opcode', '_mask',
+                 '_payload_length', '_payload_data', '_payload_start',
+                 '_masking_key')
+
+    def __init__(self):
+        self._fin = 0
+        self._rsv1 = 0
+        self._rsv2 = 0
+        self._rsv3 = 0
+        self._opcode = 0
+        self._mask = 0
+        self._payload_length = 0
+        self._payload_data = bytearray()
+        self._payload_start = 2
+        self._masking_key = b''
 
     def populateFromWebsocketFrameMessage(self, data_in_bytes):
-        self._parse_flags(data_in_bytes)
-        self._parse_payload_length(data_in_bytes)
-        self._maybe_parse_masking_key(data_in_bytes)
-        self._parse_payload(data_in_bytes)
+        # Slicing a memoryview doesn't copy, so we parse through one and only
+        # copy the payload out. The views are released before we return, so
+        # the caller is free to resize its buffer afterwards.
+        with memoryview(data_in_bytes) as data_view:
+            self._parse_header(data_view)
+            self._parse_payload(data_view)
 
-    def _parse_flags(self, data_in_bytes):
-        first_byte = data_in_bytes[0]
+    def _parse_header(self, data_in_bytes):
+        # Everything before the payload is parsed in one go: the flags, the
+        # payload length and the masking key.
+        first_byte, second_byte = struct.unpack_from('!BB', data_in_bytes, 0)
         # Bad python formatting, but it helps to see where each one is.
         self._fin    = first_byte & 0b10000000
         self._rsv1   = first_byte & 0b01000000
         self._rsv2   = first_byte & 0b00100000
         self._rsv3   = first_byte & 0b00010000
         self._opcode = first_byte & 0b00001111
+        self._mask   = second_byte & 0b10000000
 
-        second_byte = data_in_bytes[1]
-        self._mask = second_byte & 0b10000000
-
-    def _parse_payload_length(self, data_in_bytes):
-        # The payload length is the first 7 bits of the 2nd byte, or more if
-        # it's longer.
-        payload_length = (data_in_bytes[1]) & 0b01111111
-        # We can also parse the mask key at the same time. If the payload
-        # length is <126, the mask will start at the 3th byte.
-        mask_key_start = 2
-        # Depending on the payload length, the masking key may be offset by
-        # some number of bytes. We can assume big endian for now because I'm
-        # just running it locally.
-        if payload_length == 126:
-            # If the length is 126, then the length also includes the next 2
-            # bytes. Also parse length into first length byte to get rid of
-            # mask bit.
-            payload_length = int.from_bytes(
-                (bytes(payload_length) + data_in_bytes[2:4]),
-                byteorder='big')
-            # This will also mean the mask is offset by 2 additional bytes.
-            mask_key_start = 4
-        elif payload_length == 127:
-            # If the length is 127, then the length also includes the next 8
-            # bytes. Also parse length into first length byte to get rid of
-            # mask bit.
-            payload_length = int.from_bytes(
-                (bytes(payload_length) + data_in_bytes[2:9]),
-                byteorder='big')
-            # This will also mean the mask is offset by 8 additional bytes.
-            mask_key_start = 10
-        self._payload_length = payload_length
-        self._mask_key_start = mask_key_start
-
-    def _maybe_parse_masking_key(self, data_in_bytes):
-        if not self._mask:
-            return
-        self._masking_key = data_in_bytes[
-            self._mask_key_start:self._mask_key_start + 4]
+        lengths = _parse_frame_lengths(data_in_bytes)
+        if lengths is None:
+            raise ValueError('Incomplete websocket frame header')
+        header_length, self._payload_length = lengths
+
+        # If we have a mask, it's the last 4 bytes of the header. Either way,
+        # the payload starts right after the header.
+        if self._mask:
+            self._masking_key = bytes(
+                data_in_bytes[header_length - 4:header_length])
+        self._payload_start = header_length
 
     def _parse_payload(self, data_in_bytes):
-        # All client data_in_bytess should be masked
-        payload_data = b''
+        # All client frames should be masked
         if (self._payload_length == 0):
-            return payload_data
-        if self._mask:
-            # Get the masking key
-            payload_start = self._mask_key_start + 4
-            encoded_payload = data_in_bytes[payload_start:]
-            # To decode the payload, we do a bitwise OR with the mask at the
-            # mask index determined by the payload index modulo 4.
-            decoded_payload = [
-                byte ^ self._masking_key[i % 4]
-                for i, byte in enumerate(encoded_payload)]
-            payload_data = bytes(decoded_payload)
-        else:
-            # If we don't have a mask, the payload starts where the mask would
-            # have.
-            payload_start = self._mask_key_start
-            payload_data = data_in_bytes[payload_start:]
-        self._payload_data = payload_data
+            return
+        payload_start = self._payload_start
+        with data_in_bytes[payload_start:
+                           payload_start + self._payload_length] as payload:
+            if self._mask:
+                self._payload_data = _unmask(payload, self._masking_key)
+            else:
+                self._payload_data = bytearray(payload)
 
     def get_payload_data(self):
         return self._payload_data
@@ -0,0 +1,53 @@
+/*
+ * SIMD websocket unmasking, loaded by toy_websocket_frame via ctypes.
+ *
+ * Build it next to toy_websocket_frame.py with:
+ *
+ *     cc -O3 -march=native -shared -fPIC -o ws_mask.so ws_mask.c
+ *
+ * If ws_mask.so isn't there, toy_websocket_frame falls back to Python.
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+#if defined(__AVX2__)
+#include <immintrin.h>
+#elif defined(__SSE2__)
+#include <emmintrin.h>
+#endif
+
+/*
+ * XORs len bytes of src with the 4 byte key into dst. dst and src may be the
+ * same buffer. The key should already be rotated so that key[0] lines up with
+ * src[0].
+ */
+void ws_unmask(uint8_t *dst, const uint8_t *src, size_t len,
+               const uint8_t *key)
+{
+    size_t i = 0;
+    uint32_t key32;
+    memcpy(&key32, key, 4);
+
+#if defined(__AVX2__)
+    /* Every chunk is a multiple of 4 bytes, so the key stays lined up. */
+    __m256i key256 = _mm256_set1_epi32((int)key32);
+    for (; i + 32 <= len; i += 32) {
+        __m256i chunk = _mm256_loadu_si256((const __m256i *)(src + i));
+        _mm256_storeu_si256((__m256i *)(dst + i),
+                            _mm256_xor_si256(chunk, key256));
+    }
+#elif defined(__SSE2__)
+    __m128i key128 = _mm_set1_epi32((int)key32);
+    for (; i + 16 <= len; i += 16) {
+        __m128i chunk = _mm_loadu_si128((const __m128i *)(src + i));
+        _mm_storeu_si128((__m128i *)(dst + i), _mm_xor_si128(chunk, key128));
+    }
+#endif
+
+    /* Scalar tail. i is a multiple of 4 here, so i % 4 still indexes the key. */
+    for (; i < len; i++) {
+        dst[i] = src[i] ^ key[i % 4];
+    }
+}